@@ -1,16 +1,26 @@
 # main.py
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.security import APIKeyHeader
-from sqlalchemy import create_engine, Column, String, ForeignKey
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
-from pydantic import BaseModel
+from sqlalchemy import create_engine, event, inspect, text, select, exists, and_, or_, bindparam, String, LargeBinary, ForeignKey, Index
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.schema import CreateIndex, CreateTable
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, sessionmaker
+from cachetools import TTLCache
 import click
 import httpx
+import ormsgpack
 import pyperclip
 import uvicorn
+import atexit
+import functools
+import hashlib
 import os
 import secrets
+from typing import Optional
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -24,103 +34,256 @@ if not SECRET_KEY:
 
 # Configuration
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///noclip.db')
+ASYNC_DATABASE_URL = os.getenv(
+    'ASYNC_DATABASE_URL',
+    DATABASE_URL.replace('sqlite://', 'sqlite+aiosqlite://', 1) if DATABASE_URL.startswith('sqlite://') else DATABASE_URL
+)
 PORT = int(os.getenv('PORT', '8000'))
 HOST = os.getenv('HOST', '0.0.0.0')
+WORKERS = int(os.getenv('WORKERS', str(max(2, os.cpu_count() or 1))))
 DEBUG = os.getenv('DEBUG', 'false').lower() == 'true'
 
 # Database setup
-Base = declarative_base()
-engine = create_engine(DATABASE_URL)
+engine_options = dict(
+    pool_size=5,
+    max_overflow=10,
+    pool_pre_ping=True,
+    connect_args={"check_same_thread": False, "timeout": 30} if DATABASE_URL.startswith("sqlite") else {},
+)
+
+# The sync engine creates the schema and serves the CLI; the API uses the async one
+engine = create_engine(DATABASE_URL, **engine_options)
+# aiosqlite defaults file databases to NullPool, which rejects the pool options
+async_engine = create_async_engine(ASYNC_DATABASE_URL, poolclass=AsyncAdaptedQueuePool, **engine_options)
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run alongside a writer; busy_timeout makes writers wait instead of failing
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+for sync_engine in (engine, async_engine.sync_engine):
+    if sync_engine.dialect.name == "sqlite":
+        event.listen(sync_engine, "connect", set_sqlite_pragmas)
+
 SessionLocal = sessionmaker(bind=engine)
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+class Base(DeclarativeBase):
+    pass
 
 class User(Base):
     __tablename__ = 'users'
-    id = Column(String, primary_key=True)
-    api_key = Column(String, unique=True)
+    id: Mapped[str] = mapped_column(String, primary_key=True)
+    # SHA-256 of the API key; the key itself is never stored
+    api_key_hash: Mapped[bytes] = mapped_column(LargeBinary(32), unique=True, index=True)
 
 class Friendship(Base):
     __tablename__ = 'friendships'
-    user_id = Column(String, ForeignKey('users.id'), primary_key=True)
-    friend_id = Column(String, ForeignKey('users.id'), primary_key=True)
+    user_id: Mapped[str] = mapped_column(String, ForeignKey('users.id'), primary_key=True)
+    friend_id: Mapped[str] = mapped_column(String, ForeignKey('users.id'), primary_key=True)
+
+    # The primary key covers (user_id, friend_id); this covers the reversed pair
+    __table_args__ = (Index('ix_friendship_friend', 'friend_id', 'user_id'),)
 
 class Clip(Base):
     __tablename__ = 'clips'
-    owner_id = Column(String, ForeignKey('users.id'), primary_key=True)
-    bucket = Column(String, primary_key=True)
-    content = Column(String)
+    owner_id: Mapped[str] = mapped_column(String, ForeignKey('users.id'), primary_key=True)
+    bucket: Mapped[str] = mapped_column(String, primary_key=True)
+    content: Mapped[Optional[str]] = mapped_column(String)
+
+def hash_api_key(api_key):
+    return hashlib.sha256(api_key.encode()).digest()
+
+# IF NOT EXISTS keeps schema setup safe when several workers start at once
+with engine.begin() as conn:
+    for table in Base.metadata.sorted_tables:
+        conn.execute(CreateTable(table, if_not_exists=True))
+
+def migrate_api_key_hashes():
+    # Older databases stored raw keys in users.api_key; hash them and clear the plaintext.
+    # Every step is idempotent, so workers starting together can all run it.
+    columns = {column["name"] for column in inspect(engine).get_columns("users")}
+    if "api_key" not in columns:
+        return
+    if "api_key_hash" not in columns:
+        try:
+            with engine.begin() as conn:
+                conn.execute(text("ALTER TABLE users ADD COLUMN api_key_hash BLOB"))
+        except OperationalError as e:
+            # Another process added it first
+            if "duplicate column" not in str(e):
+                raise
+    with engine.begin() as conn:
+        rows = conn.execute(text("SELECT id, api_key FROM users WHERE api_key IS NOT NULL")).all()
+        for user_id, api_key in rows:
+            conn.execute(
+                text("UPDATE users SET api_key_hash = :hash, api_key = NULL WHERE id = :id"),
+                {"hash": hash_api_key(api_key), "id": user_id}
+            )
+        conn.execute(text("DROP INDEX IF EXISTS ix_users_api_key"))
+
+migrate_api_key_hashes()
+
+# Also adds indexes introduced since an older database's tables were created
+with engine.begin() as conn:
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            conn.execute(CreateIndex(index, if_not_exists=True))
+
+# Hot-path statements are built once at import so SQLAlchemy's compiled cache always hits
+USER_ID_BY_KEY_HASH_STMT = select(User.id).where(User.api_key_hash == bindparam('key_hash'))
+
+USER_EXISTS_STMT = select(exists().where(User.id == bindparam('user_id')))
+
+_clip_insert = insert(Clip)
+CLIP_UPSERT_STMT = _clip_insert.on_conflict_do_update(
+    index_elements=[Clip.owner_id, Clip.bucket],
+    set_={"content": _clip_insert.excluded.content}
+)
 
-Base.metadata.create_all(engine)
+# Symmetric friendship check between users :a and :b
+FRIENDSHIP_EXISTS_STMT = select(exists().where(or_(
+    and_(Friendship.user_id == bindparam('a'), Friendship.friend_id == bindparam('b')),
+    and_(Friendship.user_id == bindparam('b'), Friendship.friend_id == bindparam('a'))
+)))
+
+# Clip content if user :u owns it or is friends with its owner; raw SQL keeps the ORM off get_clip's hot path
+CLIP_CONTENT_STMT = text(
+    "SELECT c.content FROM clips c "
+    "WHERE c.owner_id = :o AND c.bucket = :b AND (c.owner_id = :u OR EXISTS ("
+    "SELECT 1 FROM friendships f "
+    "WHERE (f.user_id = :u AND f.friend_id = :o) OR (f.user_id = :o AND f.friend_id = :u)))"
+)
+
+def prefers_plain_text(accept):
+    # True only when text/plain strictly outranks application/json, so
+    # "application/json, text/plain, */*" style headers keep getting JSON
+    quality = {}
+    for part in accept.split(","):
+        media_type, _, params = part.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        quality.setdefault(media_type.strip().lower(), q)
+    text_q = quality.get("text/plain", 0.0)
+    json_q = quality.get("application/json", quality.get("application/*", quality.get("*/*", 0.0)))
+    return text_q > json_q
+
+def unpack_single_msgpack(data):
+    body = ormsgpack.unpackb(data)
+    # unpackb ignores trailing bytes. An object that fills the whole buffer fails
+    # to decode once its last byte is cut off; one followed by extra data does not.
+    try:
+        ormsgpack.unpackb(memoryview(data)[:-1])
+    except ValueError:
+        return body
+    raise ValueError("Trailing data after msgpack object")
 
 # FastAPI app
-app = FastAPI(title="NoClip", description="Clipboard sharing between machines")
+app = FastAPI(
+    title="NoClip",
+    description="Clipboard sharing between machines",
+    default_response_class=ORJSONResponse,
+)
 
 # Auth
 api_key_header = APIKeyHeader(name="X-API-Key")
 
-def get_db():
-    db = SessionLocal()
-    try:
+# API key hash -> user id, so repeat callers skip the users lookup
+_api_key_cache = TTLCache(maxsize=10_000, ttl=60)
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
-async def get_current_user(api_key: str = Depends(api_key_header), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.api_key == api_key).first()
-    if not user:
-        raise HTTPException(status_code=401, detail="Invalid API key")
-    return user
+async def get_current_user(api_key: str = Depends(api_key_header), db: AsyncSession = Depends(get_db)):
+    api_key_hash = hash_api_key(api_key)
+    user_id = _api_key_cache.get(api_key_hash)
+    if user_id is not None:
+        return User(id=user_id, api_key_hash=api_key_hash)
 
-# API Models
-class ClipContent(BaseModel):
-    content: str
+    user_id = await db.scalar(USER_ID_BY_KEY_HASH_STMT, {'key_hash': api_key_hash})
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Invalid API key")
+    _api_key_cache[api_key_hash] = user_id
+    return User(id=user_id, api_key_hash=api_key_hash)
 
 # API Routes
-@app.put("/clip/{bucket}")
-async def put_clip(bucket: str, content: ClipContent, user = Depends(get_current_user), db: Session = Depends(get_db)):
-    clip = db.query(Clip).filter(Clip.owner_id == user.id, Clip.bucket == bucket).first()
-    if clip:
-        clip.content = content.content
-    else:
-        clip = Clip(owner_id=user.id, bucket=bucket, content=content.content)
-        db.add(clip)
-    db.commit()
+# put_clip parses its body by hand, so describe it for the OpenAPI schema here
+CLIP_BODY_SCHEMA = {
+    "type": "object",
+    "properties": {"content": {"type": "string"}},
+    "required": ["content"],
+}
+
+@app.put("/clip/{bucket}", openapi_extra={"requestBody": {
+    "required": True,
+    "content": {
+        "application/json": {"schema": CLIP_BODY_SCHEMA},
+        "application/msgpack": {"schema": CLIP_BODY_SCHEMA},
+    },
+}})
+async def put_clip(bucket: str, request: Request, user = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    # The body is just {"content": "..."}, so check it by hand rather than through a model.
+    # Large clips may arrive as msgpack, which carries the string without JSON escaping.
+    try:
+        if request.headers.get("content-type", "").startswith("application/msgpack"):
+            body = unpack_single_msgpack(await request.body())
+        else:
+            body = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Body must be valid JSON or msgpack")
+    content = body.get("content") if isinstance(body, dict) else None
+    if not isinstance(content, str):
+        raise HTTPException(status_code=422, detail="Body must be an object with a string 'content'")
+
+    await db.execute(CLIP_UPSERT_STMT, {"owner_id": user.id, "bucket": bucket, "content": content})
+    await db.commit()
     return {"status": "success"}
 
 @app.get("/clip/{owner_id}/{bucket}")
-async def get_clip(owner_id: str, bucket: str, user = Depends(get_current_user), db: Session = Depends(get_db)):
-    friendship = db.query(Friendship).filter(
-        ((Friendship.user_id == user.id) & (Friendship.friend_id == owner_id)) |
-        ((Friendship.user_id == owner_id) & (Friendship.friend_id == user.id))
-    ).first()
-    
-    if not friendship and user.id != owner_id:
-        raise HTTPException(status_code=403, detail="Not authorized to access this clip")
+async def get_clip(owner_id: str, bucket: str, request: Request, user = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    result = await db.execute(CLIP_CONTENT_STMT, {"o": owner_id, "b": bucket, "u": user.id})
+    clip = result.first()
     
-    clip = db.query(Clip).filter(Clip.owner_id == owner_id, Clip.bucket == bucket).first()
     if not clip:
+        # Only work out why on a miss
+        is_friend = await db.scalar(FRIENDSHIP_EXISTS_STMT, {'a': user.id, 'b': owner_id})
+        if not is_friend and user.id != owner_id:
+            raise HTTPException(status_code=403, detail="Not authorized to access this clip")
         raise HTTPException(status_code=404, detail="Clip not found")
-    return {"content": clip.content}
+
+    content = clip.content or ""
+    if prefers_plain_text(request.headers.get("accept", "")):
+        return Response(content=content, media_type="text/plain")
+    return {"content": content}
 
 @app.post("/users/add/{friend_id}")
-async def add_friend(friend_id: str, user = Depends(get_current_user), db: Session = Depends(get_db)):
+async def add_friend(friend_id: str, user = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     if friend_id == user.id:
         raise HTTPException(status_code=400, detail="Cannot add yourself as friend")
     
-    friend = db.query(User).filter(User.id == friend_id).first()
-    if not friend:
+    friend_exists = await db.scalar(USER_EXISTS_STMT, {'user_id': friend_id})
+    if not friend_exists:
         raise HTTPException(status_code=404, detail="User not found")
     
-    existing_friendship = db.query(Friendship).filter(
-        ((Friendship.user_id == user.id) & (Friendship.friend_id == friend_id)) |
-        ((Friendship.user_id == friend_id) & (Friendship.friend_id == user.id))
-    ).first()
+    already_friends = await db.scalar(FRIENDSHIP_EXISTS_STMT, {'a': user.id, 'b': friend_id})
     
-    if existing_friendship:
+    if already_friends:
         return {"status": "already friends"}
     
     friendship = Friendship(user_id=user.id, friend_id=friend_id)
     db.add(friendship)
-    db.commit()
+    await db.commit()
     return {"status": "success"}
 
 # CLI Configuration
@@ -128,15 +291,17 @@ CONFIG_DIR = Path.home() / ".config" / "noclip"
 CONFIG_FILE = CONFIG_DIR / "config"
 
 def load_config():
-    if not CONFIG_FILE.exists():
+    try:
+        mtime = CONFIG_FILE.stat().st_mtime_ns
+    except FileNotFoundError:
         return {}
-    
-    config = {}
+    return dict(_parse_config(mtime))
+
+@functools.lru_cache(maxsize=1)
+def _parse_config(mtime):
+    # Keyed on mtime so save_config() invalidates it
     with open(CONFIG_FILE) as f:
-        for line in f:
-            key, value = line.strip().split("=", 1)
-            config[key] = value
-    return config
+        return dict(line.strip().split("=", 1) for line in f)
 
 def save_config(config):
     CONFIG_DIR.mkdir(parents=True, exist_ok=True)
@@ -144,6 +309,7 @@ def save_config(config):
         for key, value in config.items():
             f.write(f"{key}={value}\n")
 
+@functools.lru_cache(maxsize=1)
 def get_server_url():
     server_url = os.getenv('NOCLIP_SERVER')
     if not server_url:
@@ -156,6 +322,25 @@ def get_server_url():
             )
     return server_url
 
+_http_client = None
+
+def get_http_client():
+    global _http_client
+    if _http_client is None:
+        # A custom transport ignores the client's limits/http2, so they are set here.
+        # HTTP/2 only applies behind a proxy that speaks it; uvicorn itself serves HTTP/1.1.
+        transport = httpx.HTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=10, keepalive_expiry=300),
+            retries=2,
+        )
+        _http_client = httpx.Client(transport=transport, timeout=30.0)
+        atexit.register(_http_client.close)
+    return _http_client
+
+# Clips longer than this are uploaded as msgpack
+MSGPACK_THRESHOLD = 4096
+
 # CLI
 @click.group()
 def cli():
@@ -173,7 +358,7 @@ def register(user_id: str):
         save_config(config)
         
         db = SessionLocal()
-        user = User(id=user_id, api_key=api_key)
+        user = User(id=user_id, api_key_hash=hash_api_key(api_key))
         db.add(user)
         db.commit()
         
@@ -191,7 +376,7 @@ def add(friend_id: str):
         return
     
     try:
-        response = httpx.post(
+        response = get_http_client().post(
             f"{get_server_url()}/users/add/{friend_id}",
             headers={"X-API-Key": config["api_key"]}
         )
@@ -211,11 +396,18 @@ def put(bucket: str, content: str):
         return
     
     try:
-        response = httpx.put(
-            f"{get_server_url()}/clip/{bucket}",
-            json={"content": content},
-            headers={"X-API-Key": config["api_key"]}
-        )
+        url = f"{get_server_url()}/clip/{bucket}"
+        headers = {"X-API-Key": config["api_key"]}
+        response = None
+        if len(content) > MSGPACK_THRESHOLD:
+            response = get_http_client().put(
+                url,
+                content=ormsgpack.packb({"content": content}),
+                headers={**headers, "Content-Type": "application/msgpack"}
+            )
+        # Servers without msgpack support reject it, so fall back to JSON
+        if response is None or response.status_code in (415, 422):
+            response = get_http_client().put(url, json={"content": content}, headers=headers)
         response.raise_for_status()
         click.echo(f"Content stored in bucket '{bucket}'")
     except Exception as e:
@@ -232,12 +424,15 @@ def get(owner_id: str, bucket: str):
         return
     
     try:
-        response = httpx.get(
+        response = get_http_client().get(
             f"{get_server_url()}/clip/{owner_id}/{bucket}",
-            headers={"X-API-Key": config["api_key"]}
+            headers={"X-API-Key": config["api_key"], "Accept": "text/plain"}
         )
         response.raise_for_status()
-        content = response.json()["content"]
+        if response.headers.get("content-type", "").startswith("text/plain"):
+            content = response.text
+        else:
+            content = response.json()["content"]
         pyperclip.copy(content)
         click.echo(f"Content from {owner_id}'s bucket '{bucket}' copied to clipboard")
     except Exception as e:
@@ -246,6 +441,15 @@ def get(owner_id: str, bucket: str):
 if __name__ == "__main__":
     import sys
     if len(sys.argv) > 1 and sys.argv[1] == "serve":
-        uvicorn.run(app, host=HOST, port=PORT)
+        # Workers are separate processes, so uvicorn needs the app as an import string
+        uvicorn.run(
+            "main:app",
+            host=HOST,
+            port=PORT,
+            workers=WORKERS,
+            loop="auto",
+            http="httptools",
+            log_level="debug" if DEBUG else "warning",
+        )
     else:
         cli()
\ No newline at end of file